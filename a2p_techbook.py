@@ -21,9 +21,11 @@
 #***************************************************************************
 
 import os
-import datetime
-from pathlib import Path
-from PyPDF2 import PdfFileMerger
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from xml.etree import ElementTree
 from PySide import QtGui, QtCore
 import FreeCADGui
 import FreeCAD
@@ -65,6 +67,8 @@ recent assembly are collected.
 class A2PCreateTechBook:
     STANDARDS_FIELDS_NAME = ("Stating_Page", "Nb_Page_After", "Date_Field", "Scale_Field", "Sheet_Field")
     INFO_SPREADSHEET_LABEL = "#TECHINFO#"
+    # Data read from a file, by real path: {'mtime', 'size', 'pages', 'a2p_objects'}
+    _doc_cache = {}
 
     def _getUserParameters(self, working_dir):
         """ Asks questions to user and return information given.
@@ -131,16 +135,27 @@ class A2PCreateTechBook:
         if not sheet:
             return
         temp_dict = {}
+        get = sheet[0].get
         idx = 1
-        run = True
-        while run:
-            try:
-                key = sheet[0].get('A{}'.format(idx))
-                val = sheet[0].get('B{}'.format(idx))
-                temp_dict[key] = val
+        if hasattr(sheet[0], 'getNonEmptyCells'):
+            # We read the filled cells once and stop at the first empty row
+            cells = set(sheet[0].getNonEmptyCells())
+            key_cell, val_cell = 'A1', 'B1'
+            while key_cell in cells and val_cell in cells:
+                temp_dict[get(key_cell)] = get(val_cell)
                 idx += 1
-            except ValueError:
-                run = False
+                key_cell, val_cell = f'A{idx}', f'B{idx}'
+        else:
+            # Older FreeCAD versions raise ValueError on an empty cell
+            run = True
+            while run:
+                try:
+                    key = get(f'A{idx}')
+                    val = get(f'B{idx}')
+                    temp_dict[key] = val
+                    idx += 1
+                except ValueError:
+                    run = False
         # We set the ret_val
         for k, v in temp_dict.items():
             if k in A2PCreateTechBook.STANDARDS_FIELDS_NAME:
@@ -153,83 +168,208 @@ class A2PCreateTechBook:
             else:
                 editable_fields[k] = v
 
-    def _getDocumentTechDraw(self, full_filename, treated):
+    def _getOpenedDocuments(self):
         """
-        Extract all the TechDraw elements from a document.
+        Index the documents already opened in FreeCAD by their real path.
+        :return: dictionary {real path: document}
+        """
+        return {os.path.realpath(doc.FileName): doc
+                for doc in FreeCAD.listDocuments().values() if doc.FileName}
+
+    def _scanTechDrawPages(self, full_filename):
+        """
+        Read the names of the TechDraw pages directly from the Document.xml
+        of the file, without loading the document in FreeCAD. The types
+        derived from DrawPage, like TechDraw::DrawPagePython, are included.
         :param full_filename: Filename with the document
-        :param treated: list of document already treated
-        :return: A tuple with the open document and a list of TechDraw
-        the return value is (None, None) if the document does not exist
-        if the document has no tech draw elements, the ret_val is (doc, [])
+        :return: list of the DrawPage object names
+        """
+        names = []
+        with zipfile.ZipFile(full_filename) as fcstd:
+            with fcstd.open('Document.xml') as xml:
+                for event, elem in ElementTree.iterparse(xml, events=('end',)):
+                    if elem.tag == 'Object':
+                        if elem.get('type', '').startswith("TechDraw::DrawPage"):
+                            names.append(elem.get('name'))
+                    elif elem.tag == 'Objects':
+                        # Object data are after, we don't need them
+                        break
+        return names
+
+    def _getDocumentTechDraw(self, real_filename, treated, opened_docs):
+        """
+        Extract all the TechDraw elements from a document.
+        The document is opened only if it contains TechDraw pages.
+        :param real_filename: real path (os.path.realpath) of the document
+        :param treated: set of the real paths of the files already treated
+        :param opened_docs: documents opened in FreeCAD by real path
+        :return: A list of tuple (doc, DrawPage)
+        the list is empty if the document does not exist, is already
+        treated or has no tech draw elements
+        """
+        if real_filename in treated:
+            return []
+        treated.add(real_filename)
+        doc = opened_docs.get(real_filename)
+        if not doc:
+            try:
+                names = self._getTechDrawPageNames(real_filename)
+            except (OSError, KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+                print("File {} could not be opened !".format(real_filename))
+                return []
+            if not names:
+                return []
+            try:
+                doc = FreeCAD.openDocument(real_filename)
+            except OSError:
+                print("File {} could not be opened !".format(real_filename))
+                return []
+        return [(doc, i) for i in doc.findObjects("TechDraw::DrawPage")]
+
+    def _getCacheEntry(self, real_filename):
+        """
+        Get the cache entry of a file. The entry is emptied if the file
+        has changed on disk since it was filled.
+        :param real_filename: real path (os.path.realpath) of the document
+        :return: the cache entry (a dictionary) or None if the file
+        does not exist
         """
         try:
-            doc = FreeCAD.openDocument(full_filename)
+            stat = os.stat(real_filename)
         except OSError:
-            print("File {} could not be opened !".format(full_filename))
-            return []
-        if doc in treated:
+            return None
+        entry = A2PCreateTechBook._doc_cache.get(real_filename)
+        if not entry or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+            A2PCreateTechBook._doc_cache[real_filename] = entry
+        return entry
+
+    def _getTechDrawPageNames(self, real_filename):
+        """
+        Get the names of the TechDraw pages of a file. The result is kept
+        between calls and read again only if the file has changed on disk.
+        :param real_filename: real path (os.path.realpath) of the document
+        :return: list of the DrawPage object names
+        """
+        entry = self._getCacheEntry(real_filename)
+        if entry is None:
+            raise OSError("File {} does not exist".format(real_filename))
+        if 'pages' not in entry:
+            entry['pages'] = self._scanTechDrawPages(real_filename)
+        return entry['pages']
+
+    def _getA2pObjects(self, real_filename):
+        """
+        Read the A2p objects of a file. The result is kept between calls
+        and read again only if the file has changed on disk.
+        :param real_filename: real path (os.path.realpath) of the document
+        :return: list of the A2p objects of the document
+        """
+        entry = self._getCacheEntry(real_filename)
+        if entry is None:
             return []
-        treated.append(doc)
-        td = doc.findObjects("TechDraw::DrawPage")
-        if td:
-            ret_val = [(doc, i) for i in td]
-        else:
-            ret_val = []
-        return ret_val
+        if 'a2p_objects' not in entry:
+            reader = FCdocumentReader()
+            reader.openDocument(real_filename)
+            entry['a2p_objects'] = reader.getA2pObjects()
+        return entry['a2p_objects']
 
     def _createTechDrawDocumentList(self, file_name, file_path,
-                                    treated, recursive=True):
+                                    treated, source_cache, recursive=True):
         """
-        Create a list of document containing tech draw objects
+        Iterate over the documents containing tech draw objects
 
         :param filename: Full path of the file to treat
         :param path: directory of the file to treat
-        :param treated: list of document already treated
+        :param treated: set of the real paths of the files already treated
+        :param source_cache: dictionary of the source files already found,
+        keyed by (A2p source, directory)
         :param recursive: do we work recursively
 
-        :return: a list of tuple : (document, DrawPage)
+        :return: a generator of tuple : (document, DrawPage)
         """
-        #print("_createTechDrawDocumentList({}, {}, ...)".format(file_name, file_path))
-        full_filename = str(Path(file_path) / Path(file_name))
-        # We insert tech draw of the object given in parameter
-        ret_val = self._getDocumentTechDraw(full_filename, treated)
-        # We run throught the internal doc of the one given in parameter
-        reader = FCdocumentReader()
-        reader.openDocument(full_filename)
-        for ob in reader.getA2pObjects():
-            new_full_file = a2plib.findSourceFileInProject(ob.getA2pSource(), file_path)
-            new_full_path, new_file_name = os.path.split(new_full_file)
-            # if we are recursive, subassemblies are not treated here but in recursion
-            # otherwise, we only include tech draw from the object himself
-            if recursive and ob.isSubassembly():
-                ret_val += self._createTechDrawDocumentList(new_file_name, new_full_path, treated, recursive)
-            else:
-                ret_val += self._getDocumentTechDraw(new_full_file, treated)
-        return ret_val
+        # Local names for the functions called for each file
+        realpath = os.path.realpath
+        dirname = os.path.dirname
+        getDocumentTechDraw = self._getDocumentTechDraw
+        getA2pObjects = self._getA2pObjects
+        findSourceFileInProject = a2plib.findSourceFileInProject
+        # Documents opened during the walk are treated, no need to index them
+        opened_docs = self._getOpenedDocuments()
+        # Real paths of the assemblies whose children are already walked.
+        # A file only treated as a part is not there, its children are
+        # walked if it is reached later as a subassembly.
+        walked = set()
+        # Files to treat as (walk_it, full_filename). The last one is taken
+        # first so that the pages keep the order of the assembly tree.
+        stack = [(True, os.path.join(file_path, file_name))]
+        while stack:
+            walk_it, full_filename = stack.pop()
+            # The real path is the key of the file in all the lookups
+            real_filename = realpath(full_filename)
+            if not walk_it:
+                yield from getDocumentTechDraw(real_filename, treated, opened_docs)
+                continue
+            # A subassembly used several times is only walked once
+            if real_filename in walked:
+                continue
+            walked.add(real_filename)
+            # We insert tech draw of the assembly
+            yield from getDocumentTechDraw(real_filename, treated, opened_docs)
+            # We run throught the internal doc of the assembly
+            file_path = dirname(full_filename)
+            children = []
+            for ob in getA2pObjects(real_filename):
+                source = ob.getA2pSource()
+                key = (source, file_path)
+                if key in source_cache:
+                    new_full_file = source_cache[key]
+                else:
+                    new_full_file = findSourceFileInProject(source, file_path)
+                    source_cache[key] = new_full_file
+                # if we are recursive, subassemblies are walked too
+                # otherwise, we only include tech draw from the object himself
+                children.append((recursive and ob.isSubassembly(), new_full_file))
+            stack.extend(reversed(children))
 
-    def _computeEditableFields(self, doc, page, templates_data,
-                               date_field, scale_field):
+    def _formatModifiedDate(self, doc):
         """
-        Set the parameters in page template and recompute the doc
-        :param doc: Document the draw page is from
+        Format the last modification date of a document
+        :param doc: FreeCAD document
+        :return: the date as dd/mm/yyyy
+        """
+        # LastModifiedDate is always YYYY-MM-DDTHH:MM:SS[Z]
+        modified_date = doc.LastModifiedDate
+        return modified_date[8:10] + '/' + modified_date[5:7] + '/' + modified_date[0:4]
+
+    def _computeEditableFields(self, page, static_fields, date_field, date,
+                               scale_field, sheet_field, sheet):
+        """
+        Set the parameters in page template and recompute the doc.
+        Nothing is done if the template already has these values and the
+        page does not need a recompute.
         :param page: Draw page
-        :param templates_data: all editable data
+        :param static_fields: editable data shared by all the pages
         :param date_field: name of the date field
+        :param date: date of the page
         :param scale_field: name of the scale field
+        :param sheet_field: name of the sheet field
+        :param sheet: sheet number of the page
         :return:
         """
         texts = page.Template.EditableTexts
-
-        # Python datetime does not support time ending with Z
-        if doc.LastModifiedDate[-1] == 'Z':
-            modified = datetime.datetime.fromisoformat(doc.LastModifiedDate[:-1])
-        else:
-            modified = datetime.datetime.fromisoformat(doc.LastModifiedDate)
-        texts[date_field] = modified.strftime("%d/%m/%Y")
-        texts[scale_field] = str(page.Scale)
-        for k, v in templates_data.items():
+        old_texts = dict(texts)
+        if date_field in texts:
+            texts[date_field] = date
+        if scale_field in texts:
+            texts[scale_field] = str(page.Scale)
+        for k, v in static_fields.items():
             if k in texts:
                 texts[k] = v
+        if sheet_field in texts:
+            texts[sheet_field] = sheet
+        if texts == old_texts and 'Touched' not in page.State:
+            return
         page.Template.EditableTexts = texts
         page.recompute()
 
@@ -248,32 +388,108 @@ class A2PCreateTechBook:
         date_field = standard_fields['Date_Field']
         scale_field = standard_fields['Scale_Field']
         sheet_field = standard_fields['Sheet_Field']
-        templates_data = editable_fields.copy()
+        # Only the sheet field changes from a page to the other
+        static_fields = {k: v for k, v in editable_fields.items() if k != sheet_field}
+        # A document often holds several pages, its date is computed once
+        dates = {}
         page_edited = standard_fields['Stating_Page']
         for doc, page in doc_list:
-            templates_data[sheet_field] = "{} / {}".format(page_edited, nb_page)
-            self._computeEditableFields(doc, page, templates_data, date_field, scale_field)
+            date = dates.get(doc.Name)
+            if date is None:
+                date = dates[doc.Name] = self._formatModifiedDate(doc)
+            sheet = "{} / {}".format(page_edited, nb_page)
+            self._computeEditableFields(page, static_fields, date_field, date,
+                                        scale_field, sheet_field, sheet)
             page_edited += 1
 
-    def _createPDFFile(self, base_doc, doc_list, filename):
+    def _mergePDFWithQpdf(self, tmp_dir, pdf_files, filename):
         """
-        Create all the PDF files from the tech draw and merge them to a uniq file.
-        :param base_doc: Master A2P file
-        :param doc_list: list of tuple (doc, techDrawPage)
+        Merge the PDF files with the qpdf command line tool, if available.
+        :param tmp_dir: directory holding the PDF files
+        :param pdf_files: list of the PDF files to merge, in order
+        :param filename: file to save the final pdf
+        :return: True if the file has been created by qpdf
+        """
+        qpdf = shutil.which("qpdf")
+        if not qpdf:
+            return False
+        # qpdf runs in tmp_dir and gets the short page names, so that the
+        # command line stays under the Windows length limit for big books
+        pages = [os.path.basename(i) for i in pdf_files]
+        # No console window over the FreeCAD GUI on Windows
+        creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        try:
+            subprocess.run([qpdf, "--no-warn", "--warning-exit-0", "--empty",
+                            "--pages"] + pages + ["--", os.path.abspath(filename)],
+                           cwd=tmp_dir, creationflags=creationflags, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("qpdf could not merge the pages ({}), merging them in Python".format(e))
+            return False
+        return True
+
+    def _mergePDFWithPython(self, pdf_files, filename):
+        """
+        Merge the PDF files with pikepdf, or with PyPDF2 if pikepdf is not
+        installed. The PDF files are removed once merged by pikepdf.
+        :param pdf_files: list of the PDF files to merge, in order
         :param filename: file to save the final pdf
-        :return: return the list of files created
+        :return: True if the file has been created
         """
-        nb = 1
+        try:
+            import pikepdf
+        except ImportError:
+            pikepdf = None
+        if pikepdf:
+            book = pikepdf.Pdf.new()
+            for pdf_file in pdf_files:
+                with pikepdf.Pdf.open(pdf_file) as src:
+                    book.pages.extend(src.pages)
+                # The page is copied, we free the disk space now
+                os.unlink(pdf_file)
+            book.save(filename, linearize=False)
+            return True
+        try:
+            from PyPDF2 import PdfFileMerger
+        except ImportError:
+            QtGui.QMessageBox.warning(QtGui.QApplication.activeWindow(),
+                                      u"Technical book generation aborted!",
+                                      u"The qpdf tool or one of the pikepdf and PyPDF2 "
+                                      u"python modules is needed to merge the pages."
+                                      )
+            return False
         pdf_merger = PdfFileMerger()
-        for doc, page in doc_list:
-            pdf_file = base_doc.getTempFileName("Page{}".format(nb)) + ".pdf"
-            if not page.Visibility:
-                page.ViewObject.doubleClicked()
-            TechDrawGui.exportPageAsPdf(page, pdf_file)
+        for pdf_file in pdf_files:
             pdf_merger.append(pdf_file)
-            nb += 1
         with open(filename, "wb") as output_file:
             pdf_merger.write(output_file)
+        pdf_merger.close()
+        return True
+
+    def _createPDFFile(self, doc_list, filename):
+        """
+        Create all the PDF files from the tech draw and merge them to a uniq file.
+        The PDF files of the pages are created in a temporary directory
+        removed at the end.
+        :param doc_list: list of tuple (doc, techDrawPage)
+        :param filename: file to save the final pdf
+        :return: True if the file has been created
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='a2p_techbook_')
+        try:
+            # TechDrawGui renders through Qt, so the export has to stay on the
+            # GUI thread. We first export every page, then merge them in order.
+            pdf_files = []
+            for nb, (doc, page) in enumerate(doc_list, 1):
+                pdf_file = os.path.join(tmp_dir, f"Page{nb}.pdf")
+                if not page.Visibility:
+                    page.ViewObject.doubleClicked()
+                TechDrawGui.exportPageAsPdf(page, pdf_file)
+                pdf_files.append(pdf_file)
+            if self._mergePDFWithQpdf(tmp_dir, pdf_files, filename):
+                return True
+            return self._mergePDFWithPython(pdf_files, filename)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     def Activated(self):
         doc = FreeCAD.activeDocument()
@@ -292,11 +508,13 @@ class A2PCreateTechBook:
         standard_fields = {}
         editable_fields = {}
         self._getBookParameters(doc, standard_fields, editable_fields)
-        doc_list = self._createTechDrawDocumentList(doc_filename, path,
-                                                    treated=[],
-                                                    recursive=recursion)
+        doc_list = list(self._createTechDrawDocumentList(doc_filename, path,
+                                                         treated=set(),
+                                                         source_cache={},
+                                                         recursive=recursion))
         self._computeTechDraw(doc_list, standard_fields, editable_fields)
-        self._createPDFFile(doc, doc_list, filename)
+        if not self._createPDFFile(doc_list, filename):
+            return
         QtGui.QMessageBox.information(QtGui.QApplication.activeWindow(),
                                       u"TechBook completed",
                                       u"File {} created.".format(filename)